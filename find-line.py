@@ -10,52 +10,208 @@ The game will only report that the main program failed, and will
 treat the import_code statements like the file is expanded in-place.
 """
 
-from typing import Tuple, List, Optional
+from typing import Sequence, Tuple, List, Set, Iterator, Optional
+import argparse
+import functools
+import mmap
 import os
 import sys
-import re
 
 CONTEXT_LINES = 5
-IMPORT_RE = re.compile(r'^\s*import_code\s*\(\s*"([^"]+)"\s*\)\s*$')
+OUTPUT_BATCH_LINES = 1000
+MMAP_MIN_SIZE = 64 * 1024
+IMPORT_KEYWORD = "import_code"
 
 
-def read_file(
-    filename: str, current_line: List[int]
-) -> List[Tuple[str, int, int, str]]:
-    """Read the file."""
+def _parse_import(line: str) -> Optional[str]:
+    """Return the path in an 'import_code("path")' line, or None if the line
+    is not an import.  Hand matched with string operations, which is cheaper
+    than running a regular expression and building a match object."""
+    text = line.strip()
+    if not text.startswith(IMPORT_KEYWORD):
+        return None
+    text = text[len(IMPORT_KEYWORD) :].lstrip()
+    if text[:1] != "(" or text[-1:] != ")":
+        return None
+    text = text[1:-1].strip()
+    if len(text) < 3 or text[0] != '"' or text[-1] != '"':
+        return None
+    path = text[1:-1]
+    if '"' in path:
+        return None
+    return path
+
+
+class ParsedFile:
+    """The lines of one source file.  The import_code references are kept as
+    a separate, much shorter list, instead of being tagged onto every line."""
+
+    __slots__ = ("lines", "imports")
+
+    def __init__(self, *, lines: List[str], imports: List[Tuple[int, str]]) -> None:
+        self.lines = lines
+        # (0-based line index, imported path), in line order.
+        self.imports = imports
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_file(real_path: str) -> ParsedFile:
+    """Read a file's lines and the import_code references.  Cached, so files
+    imported from many places are only read once."""
+    # Pull the whole file in at once; the lines are all kept anyway.
+    with open(real_path, "rb") as fis:
+        if os.fstat(fis.fileno()).st_size >= MMAP_MIN_SIZE:
+            # Decode straight from the mapped pages, skipping the read buffer copy.
+            with mmap.mmap(fis.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                text = str(mapped, "utf-8")
+        else:
+            text = fis.read().decode("utf-8")
+    if "\r" in text:
+        # Same newline handling as reading in text mode.
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    lines = text.split("\n")
+    if lines[-1] == "":
+        # Trailing newline, or an empty file.
+        lines.pop()
+    lines = [line.rstrip() for line in lines]
+    imports: List[Tuple[int, str]] = []
+    if IMPORT_KEYWORD not in text:
+        # Leaf file; one search over the whole text saves scanning each line.
+        return ParsedFile(lines=lines, imports=imports)
+    for index, line in enumerate(lines):
+        if IMPORT_KEYWORD not in line:
+            # Cheap reject; most lines are not imports.
+            continue
+        imported = _parse_import(line)
+        if imported is not None:
+            imports.append((index, imported))
+    return ParsedFile(lines=lines, imports=imports)
+
+
+def _dir_prefix(filename: str) -> str:
+    """The file's directory, ready to have a relative name appended to it."""
     parent = os.path.dirname(filename)
-    ret: List[Tuple[str, int, int, str]] = []
-    orig_lineno = 1
-    with open(filename, "r", encoding="utf-8") as fis:
-        for line in fis.readlines():
-            line = line.rstrip()
-            ret.append((filename, current_line[0], orig_lineno, line))
-            current_line[0] += 1
-            orig_lineno += 1
-            mtc = IMPORT_RE.match(line)
-            if mtc is not None:
-                imported = os.path.join(parent, mtc.group(1))
-                ret.extend(read_file(imported, current_line))
-    return ret
+    if parent and not parent.endswith(os.sep):
+        return parent + os.sep
+    return parent
+
+
+def iter_lines(
+    filename: str,
+    min_line: int = 0,
+    max_line: Optional[int] = None,
+) -> Iterator[Tuple[str, int, int, str]]:
+    """Generate the file's lines, expanding the imported files in-place.
+    Lines numbered before min_line are counted but not generated, and
+    generation stops after max_line."""
+    # A plain local int keeps the counter updates cheap in the hot loop.
+    current_line = 1
+    # Each frame is (filename, real path, parent directory prefix, parsed file,
+    # next line index, next import index).  Imports push a new frame rather
+    # than recursing.
+    real_path = os.path.realpath(filename)
+    stack: List[Tuple[str, str, str, ParsedFile, int, int]] = [
+        (filename, real_path, _dir_prefix(filename), _parse_file(real_path), 0, 0)
+    ]
+    # Real paths of the files currently being expanded, to catch import cycles.
+    active: Set[str] = {real_path}
+    while stack:
+        src_file, real_path, prefix, parsed, pos, import_pos = stack.pop()
+        lines = parsed.lines
+        imports = parsed.imports
+        # Generate the lines up to and including the next import.
+        if import_pos < len(imports):
+            end = imports[import_pos][0] + 1
+        else:
+            end = len(lines)
+        skip = min_line - current_line
+        if skip > 0:
+            # Jump over the lines before the requested start in one step.
+            skip = min(skip, end - pos)
+            current_line += skip
+            pos += skip
+        stop = end
+        if max_line is not None:
+            stop = min(end, pos + max(0, max_line + 1 - current_line))
+        for index in range(pos, stop):
+            yield src_file, current_line, index + 1, lines[index]
+            current_line += 1
+        if max_line is not None and current_line > max_line:
+            # The window is done; don't open any more imports.
+            return
+        if import_pos >= len(imports):
+            # Finished with this file.
+            active.discard(real_path)
+            continue
+        # Come back to the rest of this file after the imported one.
+        stack.append((src_file, real_path, prefix, parsed, end, import_pos + 1))
+        imported = imports[import_pos][1]
+        if not imported.startswith("/"):
+            imported = prefix + imported
+        # Interned, so every line generated for a file shares one name
+        # object no matter how many times the file is imported.
+        imported = sys.intern(imported)
+        imported_real = os.path.realpath(imported)
+        if imported_real in active:
+            sys.stderr.write(
+                f"Warning: import cycle; [{src_file}:{end}] imports {imported}, "
+                "which is already being imported.  Not expanding it again.\n"
+            )
+            continue
+        active.add(imported_real)
+        stack.append(
+            (
+                imported,
+                imported_real,
+                _dir_prefix(imported),
+                _parse_file(imported_real),
+                0,
+                0,
+            )
+        )
 
 
 def find_lineno(filename: str, lineno: Optional[int]) -> None:
     """Find the line number in the main file, following imports."""
-    all_lines = read_file(filename, [1])
     min_line = 0 if lineno is None else lineno - CONTEXT_LINES
-    max_line = 0 if lineno is None else lineno + CONTEXT_LINES
-    for src_file, global_lineno, src_lineno, src_line in all_lines:
-        if lineno is None or (min_line <= global_lineno <= max_line):
-            print(f"[{src_file}:{src_lineno}] {global_lineno}  {src_line}")
+    max_line = None if lineno is None else lineno + CONTEXT_LINES
+    # Batch up the output rather than writing each line on its own.
+    pending: List[str] = []
+    for src_file, global_lineno, src_lineno, src_line in iter_lines(
+        filename, min_line, max_line
+    ):
+        pending.append(f"[{src_file}:{src_lineno}] {global_lineno}  {src_line}\n")
+        if len(pending) >= OUTPUT_BATCH_LINES:
+            sys.stdout.writelines(pending)
+            pending.clear()
+    sys.stdout.writelines(pending)
+
+
+def main(args: Sequence[str]) -> int:
+    """CLI Entrypoint."""
+    parser = argparse.ArgumentParser(
+        prog="find-line.py",
+        description=(
+            "Use to help you find the original line number through all your imports."
+        ),
+    )
+    parser.add_argument(
+        "filename",
+        help="Main program source file.",
+    )
+    parser.add_argument(
+        "lineno",
+        type=int,
+        nargs="?",
+        help=(
+            "Line number in question, as reported by the game.  "
+            "If not given, every line is reported."
+        ),
+    )
+    parsed = parser.parse_args(args[1:])
+    find_lineno(parsed.filename, parsed.lineno)
+    return 0
 
 
 if __name__ == "__main__":
-    if "-h" in sys.argv or "--help" in sys.argv or len(sys.argv) not in (2, 3):
-        print("Usage: find-line.py (main filename) (linenumber in question)")
-        print("Use to help you find the original line number through all your imports.")
-        sys.exit(1)
-    if len(sys.argv) == 2:
-        findl = None
-    else:
-        findl = int(sys.argv[2])
-    find_lineno(sys.argv[1], findl)
+    sys.exit(main(sys.argv))
@@ -34,6 +34,7 @@ from typing import (
     Mapping,
     Set,
     Tuple,
+    Iterator,
     Callable,
     Union,
     Optional,
@@ -42,11 +43,20 @@ from typing import (
 import os
 import sys
 import glob
+import fnmatch
 import argparse
+import array
 import base64
 import json
 import re
+import struct
+import functools
+import heapq
+import itertools
+import operator
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 FILE_VERSION__UNCOMPRESSED = 1
 FILE_VERSION__COMPRESSED = 2
@@ -56,46 +66,46 @@ VERBOSE = [False]
 MAXIMUM_GREYHACK_FILE_SIZE = 160000
 
 
-def debug(msg: str, **args: Any) -> None:
+def _write_debug(msg: str, **args: Any) -> None:
     """Debug message."""
-    if VERBOSE[0]:
-        sys.stderr.write("[DEBUG] " + (msg.format(**args)) + "\n")
+    sys.stderr.write("[DEBUG] " + (msg.format(**args)) + "\n")
 
 
-def log_error(msg: str, **args: Any) -> None:
-    """Error message."""
-    sys.stderr.write("Error: " + (msg.format(**args)) + "\n")
+def _skip_debug(msg: str, **args: Any) -> None:
+    """Debug message, with verbose output turned off."""
 
 
-# -----------------------------------------------
-# Low level data converters
-def mk_uint8(value: int) -> bytes:
-    """Turn an int value into a uint8 value in a byte stream."""
-    assert 0 <= value <= 255, f"uint16 value out of ramge ({value})"
-    return value.to_bytes(1, "big")
+# Bound by set_verbose, so a quiet run doesn't check the flag on every call.
+debug: Callable[..., None] = _skip_debug
+
 
+def set_verbose(verbose: bool) -> None:
+    """Turn debug messages on or off."""
+    global debug
+    VERBOSE[0] = verbose
+    debug = _write_debug if verbose else _skip_debug
 
-def mk_uint16(value: int) -> bytes:
-    """Turn an int value into a uint16 value in a byte stream."""
-    assert 0 <= value <= 65535, f"uint16 value out of ramge ({value})"
-    return value.to_bytes(2, "big")
 
+def log_error(msg: str, **args: Any) -> None:
+    """Error message."""
+    sys.stderr.write("Error: " + (msg.format(**args)) + "\n")
 
-def mk_bool(value: bool) -> bytes:
-    """Turn a boolean into a 1 or 0"""
-    return mk_uint8(1 if value else 0)
 
+# -----------------------------------------------
+# Low level data converters
 
-def mk_ref(index: int) -> bytes:
-    """Turn a reference index into a uint16 in a byte stream."""
-    return mk_uint16(index)
+# Precompiled packers for the chunk layouts.  A "ref" is a uint16 ("H"), and a
+# bool is a uint8 of 1 or 0 ("?").  Out of range values raise a struct.error.
+_PACK_CHUNK_HEADER = struct.Struct(">BH").pack
+# Chunk header plus the string block's index and length, so the text is only
+# copied once.
+_PACK_STRING_CHUNK_HEADER = struct.Struct(">BHHH").pack
 
 
 def mk_chunk(chunk_id: int, chunk_data: bytes) -> bytes:
     """Create a chunk block."""
     # A chunk is the chunk ID + chunk's data size (uint16) + data.
-    assert 0 <= chunk_id <= 255
-    ret = bytes([chunk_id]) + mk_uint16(len(chunk_data)) + chunk_data
+    ret = _PACK_CHUNK_HEADER(chunk_id, len(chunk_data)) + chunk_data
 
     # r = f"[chunk {chunk_id}]"
     # for b in ret:
@@ -105,6 +115,13 @@ def mk_chunk(chunk_id: int, chunk_data: bytes) -> bytes:
     return ret
 
 
+def _fixed_chunk_packer(chunk_id: int, data_format: str) -> Callable[..., bytes]:
+    """Create a packer for a whole chunk whose data has a fixed layout.  The
+    chunk id and data size are bound in, so it only takes the data values."""
+    packer = struct.Struct(">BH" + data_format)
+    return functools.partial(packer.pack, chunk_id, packer.size - 3)
+
+
 # -----------------------------------------------
 # Low level block creators
 
@@ -134,122 +151,141 @@ BLOCK_DELETE = 85
 
 REPLACED_WITH_HOME = "<[HOME]>"
 
+# The fixed size blocks, packed whole with one call.
+_PACK_HEADER_BLOCK = _fixed_chunk_packer(BLOCK_HEADER, "HH")
+_PACK_FOLDER_BLOCK = _fixed_chunk_packer(BLOCK_FOLDER, "HH")
+_PACK_FILE_BLOCK = _fixed_chunk_packer(BLOCK_FILE, "HHH")
+_PACK_FILEPART_CONTENTS_BLOCK = _fixed_chunk_packer(BLOCK_FILEPART_CONTENTS, "H")
+_PACK_FILEPART_LAST_BLOCK = _fixed_chunk_packer(BLOCK_FILEPART_LAST, "HH")
+_PACK_CHMOD_BLOCK = _fixed_chunk_packer(BLOCK_CHMOD, "HH?")
+_PACK_CHOWN_BLOCK = _fixed_chunk_packer(BLOCK_CHOWN, "HH?")
+_PACK_CHGROUP_BLOCK = _fixed_chunk_packer(BLOCK_CHGROUP, "HH?")
+_PACK_NEW_USER_BLOCK = _fixed_chunk_packer(BLOCK_NEW_USER, "HH")
+_PACK_NEW_GROUP_BLOCK = _fixed_chunk_packer(BLOCK_NEW_GROUP, "HH")
+_PACK_RM_USER_BLOCK = _fixed_chunk_packer(BLOCK_RM_USER, "H?")
+_PACK_RM_GROUP_BLOCK = _fixed_chunk_packer(BLOCK_RM_GROUP, "HH")
+_PACK_BUILD_BLOCK = _fixed_chunk_packer(BLOCK_BUILD, "HHH")
+_PACK_TEST_BLOCK = _fixed_chunk_packer(BLOCK_TEST, "HHH")
+_PACK_COPY_BLOCK = _fixed_chunk_packer(BLOCK_COPY, "HHH")
+_PACK_MOVE_BLOCK = _fixed_chunk_packer(BLOCK_MOVE, "HHH")
+_PACK_DELETE_BLOCK = _fixed_chunk_packer(BLOCK_DELETE, "H")
+
+
+if sys.version_info >= (3, 7):
+    # Reads the flag the string already keeps about its characters.
+    _is_ascii = str.isascii
+else:
+
+    def _is_ascii(text: str) -> bool:
+        """Python 3.6 fallback for str.isascii."""
+        try:
+            text.encode("ascii")
+            return True
+        except UnicodeEncodeError:
+            return False
+
+
+def mk_string_chunk(chunk_id: int, index: int, length: int, data: bytes) -> bytes:
+    """Create a string pool chunk; the same layout as mk_chunk, with the
+    index and character length leading the encoded text."""
+    return _PACK_STRING_CHUNK_HEADER(chunk_id, len(data) + 4, index, length) + data
+
 
 def mk_block_header(version: int) -> bytes:
     """Create a header block."""
     # version, rest of the header size.
-    return mk_chunk(BLOCK_HEADER, mk_uint16(version) + mk_uint16(0))
+    return _PACK_HEADER_BLOCK(version, 0)
 
 
 def mk_block_string(index: int, text: str, needs_home_replacement: bool) -> bytes:
     """Create a block with a referencable, indexed string."""
-    debug("Adding string {i}: '{txt}'", i=index, txt=repr(text[:20]))
-    try:
-        encoded = text.encode("ascii")
-        return mk_chunk(
+    if VERBOSE[0]:
+        debug("Adding string {i}: '{txt}'", i=index, txt=repr(text[:20]))
+    if _is_ascii(text):
+        return mk_string_chunk(
             BLOCK_ASCII_REPLACED_HOME if needs_home_replacement else BLOCK_ASCII,
-            mk_ref(index) + mk_uint16(len(text)) + encoded,
-        )
-    except UnicodeEncodeError:
-        # Strip off the leading \xff \xfe from the utf-16 string
-        encoded = text.encode("utf-16")[2:]
-        # Don't allow > 16-bit characters...
-        if len(encoded) != len(text) * 2:
-            raise RuntimeError(f"Only 2-byte UTF characters are allowed ({text})")
-        data = b""
-        for i in range(0, len(encoded), 2):
-            data += mk_uint16((encoded[i] << 8) + encoded[i + 1])
-        return mk_chunk(
-            BLOCK_UTF16_REPLACED_HOME if needs_home_replacement else BLOCK_UTF16,
-            mk_ref(index) + mk_uint16(len(text)) + data,
+            index,
+            len(text),
+            text.encode("ascii"),
         )
+    # The big endian codec writes the stream order directly, with no byte
+    # order mark to strip.
+    data = text.encode("utf-16-be")
+    # Don't allow > 16-bit characters...
+    if len(data) != len(text) * 2:
+        raise RuntimeError(f"Only 2-byte UTF characters are allowed ({text})")
+    return mk_string_chunk(
+        BLOCK_UTF16_REPLACED_HOME if needs_home_replacement else BLOCK_UTF16,
+        index,
+        len(text),
+        data,
+    )
 
 
 def mk_block_rel_home(index: int, text: str) -> bytes:
     """Create a block that goes into the string pool, but whose value is a path
     that is relative to the user's home directory."""
     # File paths are always ascii-encoded.
-    debug("Adding rel home string {i}: '{txt}'", i=index, txt=repr(text[:20]))
-    return mk_chunk(
-        BLOCK_REL_HOME, mk_ref(index) + mk_uint16(len(text)) + text.encode("ascii")
-    )
+    if VERBOSE[0]:
+        debug("Adding rel home string {i}: '{txt}'", i=index, txt=repr(text[:20]))
+    return mk_string_chunk(BLOCK_REL_HOME, index, len(text), text.encode("ascii"))
 
 
 def mk_block_folder(parent_index: int, name_index: int) -> bytes:
     """Create a folder block."""
-    return mk_chunk(BLOCK_FOLDER, mk_ref(parent_index) + mk_ref(name_index))
+    return _PACK_FOLDER_BLOCK(parent_index, name_index)
 
 
 def mk_block_file(
     dirname_index: int, filename_index: int, contents_index: int
 ) -> bytes:
     """Create a file block."""
-    return mk_chunk(
-        BLOCK_FILE,
-        mk_ref(dirname_index) + mk_ref(filename_index) + mk_ref(contents_index),
-    )
+    return _PACK_FILE_BLOCK(dirname_index, filename_index, contents_index)
 
 
 def mk_block_largefile_contents(contents_index: int) -> bytes:
     """Create a file block."""
-    return mk_chunk(
-        BLOCK_FILEPART_CONTENTS,
-        mk_ref(contents_index),
-    )
+    return _PACK_FILEPART_CONTENTS_BLOCK(contents_index)
 
 
 def mk_block_largefile_last(dirname_index: int, filename_index: int) -> bytes:
     """Create a file block."""
-    return mk_chunk(
-        BLOCK_FILEPART_LAST,
-        mk_ref(dirname_index) + mk_ref(filename_index),
-    )
+    return _PACK_FILEPART_LAST_BLOCK(dirname_index, filename_index)
 
 
 def mk_block_chmod(file_name_index: int, perms_index: int, recursive: bool) -> bytes:
     """Create a chmod block."""
-    return mk_chunk(
-        BLOCK_CHMOD,
-        mk_ref(file_name_index) + mk_ref(perms_index) + mk_bool(recursive),
-    )
+    return _PACK_CHMOD_BLOCK(file_name_index, perms_index, recursive)
 
 
 def mk_block_chown(file_name_index: int, username_index: int, recursive: bool) -> bytes:
     """Create a chown block"""
-    return mk_chunk(
-        BLOCK_CHOWN,
-        mk_ref(file_name_index) + mk_ref(username_index) + mk_bool(recursive),
-    )
+    return _PACK_CHOWN_BLOCK(file_name_index, username_index, recursive)
 
 
 def mk_block_chgroup(file_name_index: int, group_index: int, recursive: bool) -> bytes:
     """Create a chgroup block"""
-    return mk_chunk(
-        BLOCK_CHGROUP,
-        mk_ref(file_name_index) + mk_ref(group_index) + mk_bool(recursive),
-    )
+    return _PACK_CHGROUP_BLOCK(file_name_index, group_index, recursive)
 
 
 def mk_block_user(username_index: int, password_index: int) -> bytes:
     """Create a new user block."""
-    return mk_chunk(BLOCK_NEW_USER, mk_ref(username_index) + mk_ref(password_index))
+    return _PACK_NEW_USER_BLOCK(username_index, password_index)
 
 
 def mk_block_group(username_index: int, group_index: int) -> bytes:
     """Assign a user to a group, block."""
-    return mk_chunk(BLOCK_NEW_GROUP, mk_ref(username_index) + mk_ref(group_index))
+    return _PACK_NEW_GROUP_BLOCK(username_index, group_index)
 
 
 def mk_block_rm_user(username_index: int, rm_home: bool) -> bytes:
     """Remove a new user block."""
-    return mk_chunk(
-        BLOCK_RM_USER, mk_ref(username_index) + mk_uint8(1 if rm_home else 0)
-    )
+    return _PACK_RM_USER_BLOCK(username_index, rm_home)
 
 
 def mk_block_rm_group(username_index: int, group_index: int) -> bytes:
     """Remove a user from a group, block."""
-    return mk_chunk(BLOCK_RM_GROUP, mk_ref(username_index) + mk_ref(group_index))
+    return _PACK_RM_GROUP_BLOCK(username_index, group_index)
 
 
 def mk_block_build(
@@ -262,20 +298,12 @@ def mk_block_build(
         td=target_dir_index,
         tn=target_file_name_index,
     )
-    return mk_chunk(
-        BLOCK_BUILD,
-        mk_ref(source_index)
-        + mk_ref(target_dir_index)
-        + mk_ref(target_file_name_index),
-    )
+    return _PACK_BUILD_BLOCK(source_index, target_dir_index, target_file_name_index)
 
 
 def mk_block_test(test_index: int, name_index: int, file_index: int) -> bytes:
     """Create a test block."""
-    return mk_chunk(
-        BLOCK_TEST,
-        mk_uint16(test_index) + mk_ref(name_index) + mk_ref(file_index),
-    )
+    return _PACK_TEST_BLOCK(test_index, name_index, file_index)
 
 
 def mk_block_launch(argument_index: Sequence[int]) -> bytes:
@@ -284,31 +312,27 @@ def mk_block_launch(argument_index: Sequence[int]) -> bytes:
         raise RuntimeError(
             f"Launch program must have at least 1 argument, found {len(argument_index)}"
         )
-    data = mk_uint8(len(argument_index))
-    for arg in argument_index:
-        data += mk_ref(arg)
-    return mk_chunk(BLOCK_LAUNCH, data)
+    # Argument count (uint8), then each argument reference (uint16), packed
+    # into one buffer.
+    arg_count = len(argument_index)
+    data = bytearray(1 + 2 * arg_count)
+    struct.pack_into(f">B{arg_count}H", data, 0, arg_count, *argument_index)
+    return mk_chunk(BLOCK_LAUNCH, bytes(data))
 
 
 def mk_block_copy(source_index: int, target_path_idx: int, target_name: int) -> bytes:
     """Create a copy a file block."""
-    return mk_chunk(
-        BLOCK_COPY,
-        mk_ref(source_index) + mk_ref(target_path_idx) + mk_ref(target_name),
-    )
+    return _PACK_COPY_BLOCK(source_index, target_path_idx, target_name)
 
 
 def mk_block_move(source_index: int, target_path_idx: int, target_name: int) -> bytes:
     """Create a move a file block."""
-    return mk_chunk(
-        BLOCK_MOVE,
-        mk_ref(source_index) + mk_ref(target_path_idx) + mk_ref(target_name),
-    )
+    return _PACK_MOVE_BLOCK(source_index, target_path_idx, target_name)
 
 
 def mk_block_delete(file_index: int) -> bytes:
     """Create a delete a file block."""
-    return mk_chunk(BLOCK_DELETE, mk_ref(file_index))
+    return _PACK_DELETE_BLOCK(file_index)
 
 
 # -----------------------------------------------
@@ -329,6 +353,7 @@ class StoredFile:
     __slots__ = (
         "ref_id",
         "local_path",
+        "abs_local_path",
         "contents",
         "is_home_replaced",
         "is_source",
@@ -336,11 +361,10 @@ class StoredFile:
         "synthetic_game_path",
     )
 
-    _REF_INDEX = 0
-
     def __init__(
         self,
         *,
+        ref_id: int,
         local_path: Optional[str],
         contents: Optional[str],
         is_home_replaced: bool,
@@ -348,9 +372,10 @@ class StoredFile:
         requested_game_path: Optional[str],
         synthetic_game_path: Optional[str],
     ) -> None:
-        self.ref_id = StoredFile._REF_INDEX
-        StoredFile._REF_INDEX += 1
+        self.ref_id = ref_id
         self.local_path = local_path
+        # Computed once; comparisons against it happen for every import.
+        self.abs_local_path = os.path.abspath(local_path) if local_path else None
         self.contents = contents
         self.is_home_replaced = is_home_replaced
         self.is_source = is_source
@@ -367,13 +392,17 @@ class StoredFile:
                 self.local_path == other.local_path
                 and self.is_source == other.is_source
             )
+        # str caches its hash, so this rejects most differing contents
+        # without walking the text.
+        if hash(self.contents) != hash(other.contents):
+            return False
         return self.contents == other.contents
 
     def is_same_source(self, local_path: str) -> bool:
         """Is this a source file, and point to the same local path?"""
-        if not self.is_source or not self.local_path:
+        if not self.is_source or not self.abs_local_path:
             return False
-        return os.path.abspath(self.local_path) == os.path.abspath(local_path)
+        return self.abs_local_path == os.path.abspath(local_path)
 
     def __repr__(self) -> str:
         return (
@@ -414,38 +443,68 @@ class FileManager:
     references the file relative to that source file's location.
     """
 
-    __slots__ = ("stored",)
+    __slots__ = (
+        "stored",
+        "_next_ref_id",
+        "_by_requested_path",
+        "_by_ref_id",
+        "_by_source_path",
+    )
 
     IMPORT_RE = re.compile(r'^\s*import_code\s*\(\s*"([^"]+)"\s*\)\s*$')
+    COMMENT_RE = re.compile(r'"[^"]*"?|//')
     GOOD_SRC_FILE_CHARS = (
         "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789./"
     )
+    BAD_SRC_FILE_CHAR_RE = re.compile(f"[^{re.escape(GOOD_SRC_FILE_CHARS)}]")
 
     def __init__(self) -> None:
         self.stored: List[StoredFile] = []
+        # Reference ids are only unique within this manager.
+        self._next_ref_id = 0
+        # Lookup indices over the stored files.
+        self._by_requested_path: Dict[str, StoredFile] = {}
+        self._by_ref_id: Dict[int, StoredFile] = {}
+        # Source files, by the absolute local path.
+        self._by_source_path: Dict[str, StoredFile] = {}
+
+    def _new_ref_id(self) -> int:
+        """Allocate the reference id for a new stored file."""
+        ret = self._next_ref_id
+        self._next_ref_id += 1
+        return ret
+
+    def _store(self, file: StoredFile) -> None:
+        """Add the file to the stored list and the lookup indices."""
+        self.stored.append(file)
+        self._by_ref_id[file.ref_id] = file
+        if file.requested_game_path is not None:
+            self._by_requested_path.setdefault(file.requested_game_path, file)
+        if file.is_source and file.abs_local_path:
+            self._by_source_path.setdefault(file.abs_local_path, file)
 
     def get_game_file_ref(self, game_file: str) -> Optional[int]:
         """Get the stored file reference with the explicitly requested game file."""
-        for file in self.stored:
-            if file.requested_game_path == game_file:
-                return file.ref_id
-        return None
+        file = self._by_requested_path.get(game_file)
+        if file is None:
+            return None
+        return file.ref_id
 
     def get_game_file_by_ref(
         self, ref_id: int, prefer_synthetic: bool
     ) -> Optional[str]:
         """Get the game file name for the reference id."""
-        for file in self.stored:
-            if file.ref_id == ref_id:
-                if file.synthetic_game_path and prefer_synthetic:
-                    return file.synthetic_game_path
-                if file.requested_game_path and not prefer_synthetic:
-                    return file.requested_game_path
-                if file.requested_game_path:
-                    return file.requested_game_path
-                if file.synthetic_game_path:
-                    return file.synthetic_game_path
-                return None
+        file = self._by_ref_id.get(ref_id)
+        if file is None:
+            return None
+        if file.synthetic_game_path and prefer_synthetic:
+            return file.synthetic_game_path
+        if file.requested_game_path and not prefer_synthetic:
+            return file.requested_game_path
+        if file.requested_game_path:
+            return file.requested_game_path
+        if file.synthetic_game_path:
+            return file.synthetic_game_path
         return None
 
     def has_game_file(self, game_file: str) -> bool:
@@ -458,8 +517,9 @@ class FileManager:
         if self.has_game_file(game_file):
             log_error("Duplicate game file listed: {game_file}", game_file=game_file)
             return False
-        self.stored.append(
+        self._store(
             StoredFile(
+                ref_id=self._new_ref_id(),
                 local_path=None,
                 contents=contents,
                 is_home_replaced=False,
@@ -480,6 +540,7 @@ class FileManager:
             log_error("Could not find file '{local_file}'", local_file=local_file)
             return -1
         ret = StoredFile(
+            ref_id=self._new_ref_id(),
             local_path=local_file,
             contents=None,
             is_home_replaced=False,
@@ -487,7 +548,7 @@ class FileManager:
             requested_game_path=game_file,
             synthetic_game_path=None,
         )
-        self.stored.append(ret)
+        self._store(ret)
         if ret is None:
             return None
         return ret.ref_id
@@ -515,6 +576,7 @@ class FileManager:
             log_error("Could not find file '{local_file}'", local_file=local_file)
             return None
         ret = StoredFile(
+            ref_id=self._new_ref_id(),
             local_path=local_file,
             contents=None,
             # source files are defined by the spec to always have home replaced.
@@ -528,7 +590,7 @@ class FileManager:
             local_file=local_file,
             id=ret.ref_id,
         )
-        self.stored.append(ret)
+        self._store(ret)
         return ret
 
     def process_file_map(self) -> Optional[Sequence[ResolvedFile]]:
@@ -539,6 +601,28 @@ class FileManager:
 
         ret: Dict[str, ResolvedFile] = {}
         to_scan: List[StoredFile] = list(self.stored)
+        # Files with identical contents share one string, so the block string
+        # pool finds them by identity instead of comparing the full text.
+        shared_contents: Dict[str, str] = {}
+
+        # Read the files already listed in parallel; the threads wait on the
+        # file system, not the interpreter.  Files discovered through imports
+        # are loaded as they are found.
+        to_load = [
+            (source, source.local_path)
+            for source in to_scan
+            if source.contents is None and source.local_path
+        ]
+        if len(to_load) > 1:
+            with ThreadPoolExecutor() as executor:
+                loaded = executor.map(
+                    FileManager._load_file, [local_path for _, local_path in to_load]
+                )
+                for (source, _), raw in zip(to_load, loaded):
+                    if raw is None:
+                        is_ok = False
+                        raw = ""
+                    source.contents = raw
 
         while to_scan:
             source = to_scan.pop()
@@ -557,6 +641,9 @@ class FileManager:
                     )
                     is_ok = False
                 else:
+                    source.contents = shared_contents.setdefault(
+                        source.contents, source.contents
+                    )
                     if source.requested_game_path:
                         assert source.requested_game_path not in ret
                         ret[source.requested_game_path] = ResolvedFile(
@@ -607,6 +694,9 @@ class FileManager:
                         )
             elif source.contents is not None and not source.is_source:
                 # Not cleaning the contents.  It's not a source file.
+                source.contents = shared_contents.setdefault(
+                    source.contents, source.contents
+                )
                 if source.requested_game_path:
                     assert source.requested_game_path not in ret
                     ret[source.requested_game_path] = ResolvedFile(
@@ -652,7 +742,8 @@ class FileManager:
     ) -> bool:
         """Special content parsing to discover included files, as well as minimizing
         the source code."""
-        ret = ""
+        # The cleaned source has always started with a blank line; keep that.
+        ret: List[str] = [""]
         is_ok = True
         local_path = source.local_path
         contents = source.contents
@@ -690,8 +781,8 @@ class FileManager:
 
                 line = f'import_code("{imported_game_file}")'
                 debug("Replaced import code line with '{line}'", line=line)
-            ret += "\n" + line
-        source.contents = ret
+            ret.append(line)
+        source.contents = "\n".join(ret)
         return is_ok
 
     def _find_import_file(
@@ -717,12 +808,9 @@ class FileManager:
         )
         base_dir = os.path.abspath(os.path.dirname(referring_path))
         included_local = os.path.join(base_dir, imported_path)
-        found: Optional[StoredFile] = None
-        for source in self.stored:
-            if source.is_same_source(included_local):
-                found = source
-                debug("already loaded as {id}", id=source.ref_id)
-                break
+        found = self._by_source_path.get(os.path.abspath(included_local))
+        if found:
+            debug("already loaded as {id}", id=found.ref_id)
 
         if not found:
             # Need to create it.
@@ -762,27 +850,11 @@ class FileManager:
         # Easy case.  See if we even need to do anything.
         if "//" not in line:
             return line
-        state = 0
-        for pos in range(0, len(line)):
-            val = line[pos]
-            if state == 0:
-                # in plain text
-                if val == '"':
-                    state = 1
-                elif val == "/":
-                    state = 2
-                # else keep looking
-            elif state == 1:
-                # Inside a string.
-                if val == '"':
-                    state = 0
-                # else keep looking
-            elif state == 2:
-                # Found a first '/'.
-                if val == "/":
-                    # Found the second "/" outside a string.  Comment started
-                    # the character before this one.
-                    return line[: pos - 1]
+        # Each match is either a whole quoted string, which is skipped, or a
+        # '//' outside any string, which starts the comment.
+        for mtc in FileManager.COMMENT_RE.finditer(line):
+            if mtc.group() == "//":
+                return line[: mtc.start()]
         # The "//" was inside a string.
         return line
 
@@ -822,12 +894,9 @@ class FileManager:
             # else == ".", so ignore it.
         remaining = "/".join(parts)
 
-        for c in remaining:
-            if c not in FileManager.GOOD_SRC_FILE_CHARS:
-                removed += "X"
-                cleaned += "X"
-            else:
-                cleaned += c
+        replaced, bad_count = FileManager.BAD_SRC_FILE_CHAR_RE.subn("X", remaining)
+        cleaned += replaced
+        removed += "X" * bad_count
 
         if removed:
             # There were bad characters.
@@ -878,24 +947,54 @@ class FileManager:
 # Block storage
 
 
+class PendingBuild:
+    """A build of a stored source file, resolved once the file map is known."""
+
+    __slots__ = ("ref_id", "dirname_idx", "fname_idx")
+
+    def __init__(self, *, ref_id: int, dirname_idx: int, fname_idx: int) -> None:
+        self.ref_id = ref_id
+        self.dirname_idx = dirname_idx
+        self.fname_idx = fname_idx
+
+
+class PendingTest:
+    """A test of a stored source file, resolved once the file map is known."""
+
+    __slots__ = ("ref_id", "name")
+
+    def __init__(self, *, ref_id: int, name: str) -> None:
+        self.ref_id = ref_id
+        self.name = name
+
+
 class Blocks:
     """Stores the blocks"""
 
+    BACKSLASH_TO_SLASH = str.maketrans("\\", "/")
+    MULTI_SLASH_RE = re.compile(r"/{2,}")
+
     def __init__(self) -> None:
         # maps to (string index, is-home-replaced)
         self._strings: Dict[str, int] = {}
         self._home_replace_strings: Dict[str, int] = {}
         self._rel_paths: Dict[str, int] = {}
+        # Maps the path text as given to _add_path to its string index.
+        self._path_idx: Dict[str, int] = {}
         self._string_idx = 0
-        self._folders: List[Tuple[str, bytes]] = []
+        # Folder blocks, by the normalized folder path.
+        self._folders: Dict[str, bytes] = {}
         self._files = FileManager()
-        self._test_files: Dict[str, int] = {}
-        self._build_files: Dict[str, Tuple[int, int, int]] = {}
-        self._user_blocks: List[bytes] = []
-        self._group_blocks: List[bytes] = []
-        self._exec_blocks: List[Union[bytes, Tuple[bool, str]]] = []
+        # Order doesn't matter within the user and group sections, so their
+        # blocks are written straight into one buffer each.
+        self._user_blocks = bytearray()
+        self._group_blocks = bytearray()
+        self._exec_blocks: List[Union[bytes, PendingBuild, PendingTest]] = []
         self._setup_problems = False
-        self.bundle_files: List[str] = []
+        # Absolute paths of the bundle files read so far.
+        self.bundle_files: Set[str] = set()
+        # A 'bundle' block's file, waiting for process_bundle_file to load it.
+        self.pending_bundles: List[str] = []
 
     def assemble(self) -> Optional[bytes]:
         """Assemble the body of the data."""
@@ -904,165 +1003,166 @@ class Blocks:
 
         # Need to set up the files first.  That dictates folders and other things.
         # They can't be set up until all the files are added.
-        file_blocks: List[bytes] = []
         file_to_contents = self._files.process_file_map()
         if file_to_contents is None:
             return None
-        for mapped_file in file_to_contents:
-            file_blocks.append(
-                self._add_file(
-                    mapped_file.game_path,
-                    mapped_file.contents,
-                    mapped_file.is_home_replaced,
-                )
+        file_blocks: List[bytes] = [
+            self._add_file(
+                mapped_file.game_path,
+                mapped_file.contents,
+                mapped_file.is_home_replaced,
             )
+            for mapped_file in file_to_contents
+        ]
         # Now compute the execution blocks.  These require extra block
         # parsing for build and tests.
         exec_blocks: List[bytes] = []
         for block in self._exec_blocks:
             if isinstance(block, bytes):
                 exec_blocks.append(block)
-            else:
-                # It's a tuple, (true is build else test, item being processed)
-                is_build, name = block
-                if is_build:
-                    ref_id, dirname_idx, fname_idx = self._build_files[name]
-                    game_file = self._files.get_game_file_by_ref(ref_id, True)
-                    if not game_file:
-                        log_error("Failed to find game file for id {id}", id=ref_id)
-                        self._setup_problems = True
-                    else:
-                        exec_blocks.append(
-                            mk_block_build(
-                                self._add_path(game_file), dirname_idx, fname_idx
-                            )
-                        )
+            elif isinstance(block, PendingBuild):
+                game_file = self._files.get_game_file_by_ref(block.ref_id, True)
+                if not game_file:
+                    log_error("Failed to find game file for id {id}", id=block.ref_id)
+                    self._setup_problems = True
                 else:
-                    # A test file.  Use the test content of an import line to the file.
-                    ref_id = self._test_files[name]
-                    game_file = self._files.get_game_file_by_ref(ref_id, True)
-                    if game_file is None:
-                        log_error("Failed to find a game file for id {id}", id=ref_id)
-                        self._setup_problems = True
-                        continue
                     exec_blocks.append(
-                        mk_block_test(
-                            test_index=len(exec_blocks),
-                            name_index=self._add_string(name),
-                            file_index=self._add_path(game_file),
+                        mk_block_build(
+                            self._add_path(game_file),
+                            block.dirname_idx,
+                            block.fname_idx,
                         )
                     )
+            else:
+                # A test file.  Use the test content of an import line to the file.
+                game_file = self._files.get_game_file_by_ref(block.ref_id, True)
+                if game_file is None:
+                    log_error("Failed to find a game file for id {id}", id=block.ref_id)
+                    self._setup_problems = True
+                    continue
+                exec_blocks.append(
+                    mk_block_test(
+                        test_index=len(exec_blocks),
+                        name_index=self._add_string(block.name),
+                        file_index=self._add_path(game_file),
+                    )
+                )
 
         # Now all the blocks are ready to go.
 
+        # The blocks are collected in order and joined once at the end, rather
+        # than copying the whole body for every block.
+
         # Header first
-        ret = mk_block_header(FILE_VERSION__UNCOMPRESSED)
+        parts: List[Union[bytes, bytearray]] = [
+            mk_block_header(FILE_VERSION__UNCOMPRESSED)
+        ]
 
         # Then the strings
-        for text, idx in self._strings.items():
-            ret += mk_block_string(idx, text, False)
-        for text, idx in self._home_replace_strings.items():
-            ret += mk_block_string(idx, text, True)
-        for text, idx in self._rel_paths.items():
-            ret += mk_block_rel_home(idx, text)
-        # Then the folders, ordered so that they can be simply
-        # created.
-        folders = sorted(self._folders, key=lambda a: a[0])
-        for _, block in folders:
-            ret += block
+        parts.extend(
+            mk_block_string(idx, text, False) for text, idx in self._strings.items()
+        )
+        parts.extend(
+            mk_block_string(idx, text, True)
+            for text, idx in self._home_replace_strings.items()
+        )
+        parts.extend(
+            mk_block_rel_home(idx, text) for text, idx in self._rel_paths.items()
+        )
+        # Then the folders.  add_folder adds the parents before their
+        # children, so they can be simply created in the order added.
+        parts.extend(self._folders.values())
 
         # The overal order of files, users, groups, exec,
         # is very important.  Within them, it's not important.
 
         # Then the files.  Order doesn't matter here.
-        for block in file_blocks:
-            ret += block
+        parts.extend(file_blocks)
         # Then users.  Order doesn't matter.
-        for block in self._user_blocks:
-            ret += block
+        parts.append(self._user_blocks)
         # Then groups assigned to users.  Order doesn't matter.
-        for block in self._group_blocks:
-            ret += block
+        parts.append(self._group_blocks)
         # Then the other stuff.  This requires everything else to already exist.
-        for block in exec_blocks:
-            ret += block
+        parts.extend(exec_blocks)
 
         if self._setup_problems:
             return None
-        return ret
+        return b"".join(parts)
 
     def _add_string(self, text: str) -> int:
         assert len(text) < 0x10000, f"string too big ({len(text)})"
-        if text in self._strings:
-            ret = self._strings[text]
-        else:
-            ret = self._string_idx
-            self._string_idx += 1
-            self._strings[text] = ret
-        return ret
+        return self._pool_index(self._strings, text)
 
     def _add_home_replace_string(self, text: str) -> int:
         assert len(text) < 0x10000
-        if text in self._home_replace_strings:
-            ret = self._home_replace_strings[text]
-        else:
-            ret = self._string_idx
-            self._string_idx += 1
-            self._home_replace_strings[text] = ret
-        return ret
+        return self._pool_index(self._home_replace_strings, text)
 
     def _add_path(self, text: str) -> int:
+        # The same paths are added many times over.  Look up the path as given
+        # before working out which group it belongs to.
+        idx = self._path_idx.get(text)
+        if idx is not None:
+            return idx
+        path = text
         group = self._strings
-        if text == "~":
+        if path == "~":
             group = self._rel_paths
-            text = ""
-        elif text[0:2] == "~/":
+            path = ""
+        elif path[0:2] == "~/":
             group = self._rel_paths
-            text = text[2:]
-        elif text != "/" and text:
-            while text[-1] == "/":
-                text = text[:-1]
-        if text in group:
-            idx = group[text]
-        else:
-            idx = self._string_idx
+            path = path[2:]
+        elif path:
+            # Strip trailing '/', but keep the root.
+            path = path.rstrip("/") or "/"
+        idx = self._pool_index(group, path)
+        self._path_idx[text] = idx
+        return idx
+
+    def _pool_index(self, group: Dict[str, int], text: str) -> int:
+        """Get the string pool index for the text in the group, adding it if new.
+        All the groups share one index sequence."""
+        # The same text is added many times over; interned keys let the dict
+        # probe match on identity.
+        text = sys.intern(text)
+        # One probe for both cases.  Existing entries always have a lower
+        # index than the next one to hand out.
+        idx = group.setdefault(text, self._string_idx)
+        if idx == self._string_idx:
             self._string_idx += 1
-            group[text] = idx
         return idx
 
     def add_folder(self, folder_name: str) -> None:
         """Create a folder block."""
         # debug(f"ADD FOLDER [{folder_name}]")
-        if folder_name == "/" or folder_name == "~":
-            # The root was reached during recursive adds.
-            return
-
-        parent, name = Blocks._split(folder_name)
-        if name == "":
-            # this reached the root during recursive required adds.
-            # If parent isn't empty, then there was a relative
-            # directory request, which is not recommended.
-            # If the parent is empty, then it's gone up the
-            # whole tree.
-            # Ignore it.
-            return
-
-        # Check that the joint path hasn't already been added.
-        normalized = parent + "/" + name
-        for exist, _ in self._folders:
-            if exist == normalized:
-                # already added
-                return
+        # Walk up the parents until one is already added, then add the missing
+        # ones from the top down.  Ensuring the parents are added makes the
+        # bundle assembly definition simpler.
+        missing: List[Tuple[str, str, str]] = []
+        while folder_name != "/" and folder_name != "~":
+            parent, name = Blocks._split(folder_name)
+            if name == "":
+                # this reached the root.
+                # If parent isn't empty, then there was a relative
+                # directory request, which is not recommended.
+                # If the parent is empty, then it's gone up the
+                # whole tree.
+                # Ignore it.
+                break
 
-        # Ensure the parent is added, to make the bundle assembly
-        # definition simpler.
-        self.add_folder(parent)
+            # Check that the joint path hasn't already been added.
+            normalized = parent + "/" + name
+            if normalized in self._folders:
+                # already added
+                break
+            missing.append((normalized, parent, name))
+            folder_name = parent
 
-        # If the parent is empty, then a folder is being added to the
-        # root directory.
-        parent_idx = self._add_path(parent)
-        name_idx = self._add_string(name)
-        self._folders.append((normalized, mk_block_folder(parent_idx, name_idx)))
+        for normalized, parent, name in reversed(missing):
+            # If the parent is empty, then a folder is being added to the
+            # root directory.
+            parent_idx = self._add_path(parent)
+            name_idx = self._add_string(name)
+            self._folders[normalized] = mk_block_folder(parent_idx, name_idx)
 
     def add_local_text_file(self, game_file: str, local_file: str) -> None:
         """Add a local file as a plain text file."""
@@ -1100,8 +1200,7 @@ class Blocks:
             debug(
                 "Created local test file {ref_id} as {name}", ref_id=ref_id, name=name
             )
-            self._test_files[name] = ref_id
-            self._exec_blocks.append((False, name))
+            self._exec_blocks.append(PendingTest(ref_id=ref_id, name=name))
 
     def add_build(self, source: str, target: str) -> None:
         """Create a build block."""
@@ -1125,8 +1224,11 @@ class Blocks:
             source_idx = self._add_path(Blocks._normalize(source))
             self._exec_blocks.append(mk_block_build(source_idx, dirname_idx, fname_idx))
         else:
-            self._build_files[source] = (ref_id, dirname_idx, fname_idx)
-            self._exec_blocks.append((True, source))
+            self._exec_blocks.append(
+                PendingBuild(
+                    ref_id=ref_id, dirname_idx=dirname_idx, fname_idx=fname_idx
+                )
+            )
 
     def _add_file(self, file_name: str, contents: str, replace_home: bool) -> bytes:
         """Create a file block.  Called at the final assembly phase."""
@@ -1150,7 +1252,7 @@ class Blocks:
             # Split the content into parts.
             # This needs to be home replacement string sensitive, otherwise the
             # home replace token will not be replaced right if split over a part.
-            ret = b""
+            ret = bytearray()
             if replace_home:
                 between_parts = contents.split(BLOCK_FILEPART_LAST)
                 buff = ""
@@ -1165,7 +1267,7 @@ class Blocks:
                     if len(bit1) > 65531:
                         # This can only happen if buff < cap
                         assert len(buff) <= 65531
-                        ret = ret + mk_block_largefile_contents(
+                        ret += mk_block_largefile_contents(
                             self._add_home_replace_string(buff)
                         )
                         buff = ""
@@ -1173,18 +1275,17 @@ class Blocks:
                     # bit1 len <= 65531, so first time going through the
                     # path part will not split over sub.
                     buff = bit1 + part
-                while buff:
-                    part = buff[:65531]
-                    buff = buff[65531:]
-                    ret = ret + mk_block_largefile_contents(
-                        self._add_home_replace_string(part)
+                for start in range(0, len(buff), 65531):
+                    ret += mk_block_largefile_contents(
+                        self._add_home_replace_string(buff[start : start + 65531])
                     )
             else:
-                while contents:
-                    part = contents[:65531]
-                    contents = contents[65531:]
-                    ret = ret + mk_block_largefile_contents(self._add_string(part))
-            return ret + mk_block_largefile_last(dirname_idx, fname_idx)
+                for start in range(0, len(contents), 65531):
+                    ret += mk_block_largefile_contents(
+                        self._add_string(contents[start : start + 65531])
+                    )
+            ret += mk_block_largefile_last(dirname_idx, fname_idx)
+            return bytes(ret)
         else:
             # Use old stuff.
             if replace_home:
@@ -1197,13 +1298,13 @@ class Blocks:
         """Create a new user block."""
         username_idx = self._add_string(username)
         password_idx = self._add_string(password)
-        self._user_blocks.append(mk_block_user(username_idx, password_idx))
+        self._user_blocks += mk_block_user(username_idx, password_idx)
 
     def add_group(self, username: str, group: str) -> None:
         """Create a new group, or assign a user to a group, block."""
         username_idx = self._add_string(username)
         group_idx = self._add_string(group)
-        self._group_blocks.append(mk_block_group(username_idx, group_idx))
+        self._group_blocks += mk_block_group(username_idx, group_idx)
 
     def add_rm_user(self, username: str, rm_home: bool) -> None:
         """Create a new user block."""
@@ -1269,7 +1370,10 @@ class Blocks:
         path_idx = self._add_path(Blocks._normalize(path))
         self._exec_blocks.append(mk_block_delete(path_idx))
 
+    # Both are pure, and see the same paths over and over: every ancestor of
+    # every file passes through add_folder.
     @staticmethod
+    @functools.lru_cache(maxsize=8192)
     def _split(name: str) -> Tuple[str, str]:
         name = Blocks._normalize(name)
         if "/" not in name:
@@ -1280,25 +1384,37 @@ class Blocks:
         return parent, fname
 
     @staticmethod
+    @functools.lru_cache(maxsize=8192)
     def _normalize(name: str) -> str:
-        name = name.replace("\\", "/")
-        while "//" in name:
-            name = name.replace("//", "/")
-        return name
+        # A single pass each to convert '\' and to collapse runs of '/'.
+        return Blocks.MULTI_SLASH_RE.sub("/", name.translate(Blocks.BACKSLASH_TO_SLASH))
 
 
 # =====================================================================
 # Parse the JSON data.
 
 
+def get_str_values(data: Mapping[str, Any], *keys: str) -> Optional[Tuple[str, ...]]:
+    """Get the block's values for the keys, in order.  Returns None if any of
+    them are missing or not a string."""
+    ret: List[str] = []
+    for key in keys:
+        value = data.get(key)
+        if not isinstance(value, str):
+            return None
+        ret.append(value)
+    return tuple(ret)
+
+
 def parse_folder_block(
     blocks: Blocks, data: Mapping[str, Any], _context_dir: str
 ) -> bool:
     """Parse an explicit 'folder' block."""
-    name = data.get("path")
-    if name is None or not isinstance(name, str):
+    values = get_str_values(data, "path")
+    if values is None:
         log_error("'folder' block requires the folder name in the 'path' key")
         return False
+    (name,) = values
     blocks.add_folder(name)
     return True
 
@@ -1352,18 +1468,40 @@ def parse_source_block(
     blocks: Blocks, data: Mapping[str, Any], context_dir: str
 ) -> bool:
     """Parse source code block."""
-    name = data.get("path")
-    local_file = data.get("local")
-    if (name is None or not isinstance(name, str)) or (
-        local_file is None or not isinstance(local_file, str)
-    ):
+    values = get_str_values(data, "path", "local")
+    if values is None:
         log_error("'source' block requires 'path' and 'local'.")
         return False
+    name, local_file = values
 
     blocks.add_local_source_file(name, os.path.join(context_dir, local_file))
     return True
 
 
+GLOB_MAGIC_RE = re.compile(r"[*?[]")
+
+
+def find_local_files(pattern: str) -> List[str]:
+    """Find the files matching the glob pattern, like glob.iglob with an
+    os.path.isfile check.  When only the file name has wildcards, the
+    directory is listed once and the entries' own types are used instead of
+    another stat for each match."""
+    dirname, basename = os.path.split(pattern)
+    if GLOB_MAGIC_RE.search(dirname):
+        return [f for f in glob.iglob(pattern) if os.path.isfile(f)]
+    if not GLOB_MAGIC_RE.search(basename):
+        return [pattern] if os.path.isfile(pattern) else []
+    try:
+        with os.scandir(dirname or os.curdir) as entries:
+            names = [entry.name for entry in entries if entry.is_file()]
+    except OSError:
+        return []
+    if basename[0] != ".":
+        # Like glob, wildcards don't match hidden files.
+        names = [name for name in names if name[0] != "."]
+    return [os.path.join(dirname, name) for name in fnmatch.filter(names, basename)]
+
+
 def parse_test_block(blocks: Blocks, data: Mapping[str, Any], context_dir: str) -> bool:
     """Parse compiling and running a test block."""
     name = data.get("name")
@@ -1383,17 +1521,16 @@ def parse_test_block(blocks: Blocks, data: Mapping[str, Any], context_dir: str)
     assert isinstance(local_file, (tuple, list))  # nosec  # for mypy
     count = 0
     for l_f in local_file:
-        for filename in glob.iglob(os.path.join(context_dir, l_f)):
-            if os.path.isfile(filename):
-                test_name = f"{name}-{os.path.splitext(os.path.basename(filename))[0]}"
-                debug(
-                    "Adding {test} test for '{filename}' as '{test_name}'",
-                    test=name,
-                    filename=filename,
-                    test_name=test_name,
-                )
-                blocks.add_test_file(test_name, filename)
-                count += 1
+        for filename in find_local_files(os.path.join(context_dir, l_f)):
+            test_name = f"{name}-{os.path.splitext(os.path.basename(filename))[0]}"
+            debug(
+                "Adding {test} test for '{filename}' as '{test_name}'",
+                test=name,
+                filename=filename,
+                test_name=test_name,
+            )
+            blocks.add_test_file(test_name, filename)
+            count += 1
     if count <= 0:
         log_error("Found no files matching {pattern}", pattern=local_file)
         return False
@@ -1404,16 +1541,11 @@ def parse_build_block(
     blocks: Blocks, data: Mapping[str, Any], _context_dir: str
 ) -> bool:
     """A simple 'build' block."""
-    source = data.get("source")
-    target = data.get("target")
-    if (
-        source is None
-        or not isinstance(source, str)
-        or target is None
-        or not isinstance(target, str)
-    ):
+    values = get_str_values(data, "source", "target")
+    if values is None:
         log_error("'build' block requires 'source' and 'target'")
         return False
+    source, target = values
     blocks.add_build(source, target)
     return True
 
@@ -1422,19 +1554,14 @@ def parse_compile_block(
     blocks: Blocks, data: Mapping[str, Any], context_dir: str
 ) -> bool:
     """A combination source + build + test block."""
-    local_file = data.get("local")
-    test_files = data.get("local-tests")
-    target = data.get("target")
-    if (
-        local_file is None
-        or not isinstance(local_file, str)
-        or target is None
-        or not isinstance(target, str)
-    ):
+    values = get_str_values(data, "local", "target")
+    if values is None:
         log_error(
             "'compile' block requires 'local' and 'target', and optionally 'local-tests'"
         )
         return False
+    local_file, target = values
+    test_files = data.get("local-tests")
     source_name = f"{TEMP_DIR}/build.source/{os.path.basename(local_file)}"
     blocks.add_local_source_file(source_name, os.path.join(context_dir, local_file))
     # Tests run before the target builds.
@@ -1457,16 +1584,11 @@ def parse_user_block(
     blocks: Blocks, data: Mapping[str, Any], _context_dir: str
 ) -> bool:
     """Parse a create a user block."""
-    user = data.get("user")
-    passwd = data.get("password")
-    if (
-        user is None
-        or not isinstance(user, str)
-        or passwd is None
-        or not isinstance(passwd, str)
-    ):
+    values = get_str_values(data, "user", "password")
+    if values is None:
         log_error("'user' block requires 'user' and 'password'")
         return False
+    user, passwd = values
 
     blocks.add_user(user, passwd)
     return True
@@ -1476,16 +1598,11 @@ def parse_group_block(
     blocks: Blocks, data: Mapping[str, Any], _context_dir: str
 ) -> bool:
     """Parse a create/add a user to a group block."""
-    user = data.get("user")
-    group = data.get("group")
-    if (
-        user is None
-        or not isinstance(user, str)
-        or group is None
-        or not isinstance(group, str)
-    ):
+    values = get_str_values(data, "user", "group")
+    if values is None:
         log_error("'group' block requires 'user' and 'group'")
         return False
+    user, group = values
 
     blocks.add_group(user, group)
     return True
@@ -1633,16 +1750,11 @@ def parse_copy_block(
     blocks: Blocks, data: Mapping[str, Any], _context_dir: str
 ) -> bool:
     """Parse a copy file block."""
-    from_file = data.get("from")
-    to_file = data.get("to")
-    if (
-        from_file is None
-        or not isinstance(from_file, str)
-        or to_file is None
-        or not isinstance(to_file, str)
-    ):
+    values = get_str_values(data, "from", "to")
+    if values is None:
         log_error("'copy' block requires 'from' and 'to'")
         return False
+    from_file, to_file = values
 
     blocks.add_copy(from_file, to_file)
     return True
@@ -1652,16 +1764,11 @@ def parse_move_block(
     blocks: Blocks, data: Mapping[str, Any], _context_dir: str
 ) -> bool:
     """Parse a move file block."""
-    from_file = data.get("from")
-    to_file = data.get("to")
-    if (
-        from_file is None
-        or not isinstance(from_file, str)
-        or to_file is None
-        or not isinstance(to_file, str)
-    ):
+    values = get_str_values(data, "from", "to")
+    if values is None:
         log_error("'move' block requires 'from' and 'to'")
         return False
+    from_file, to_file = values
 
     blocks.add_move(from_file, to_file)
     return True
@@ -1671,10 +1778,11 @@ def parse_delete_block(
     blocks: Blocks, data: Mapping[str, Any], _context_dir: str
 ) -> bool:
     """Parse a delete file block."""
-    filename = data.get("path")
-    if filename is None or not isinstance(filename, str):
+    values = get_str_values(data, "path")
+    if values is None:
         log_error("'delete' block requires 'path'")
         return False
+    (filename,) = values
 
     blocks.add_delete(filename)
     return True
@@ -1691,13 +1799,15 @@ def parse_bundle_block(
     blocks: Blocks, data: Mapping[str, Any], context_dir: str
 ) -> bool:
     """Parse another bundle, relative to this one."""
-    local_file = data.get("local")
-    if local_file is None or not isinstance(local_file, str):
+    values = get_str_values(data, "local")
+    if values is None:
         log_error("'bundle' block requires 'local'.")
         return False
+    (local_file,) = values
 
-    # Recursion.
-    return process_bundle_file(blocks, os.path.join(context_dir, local_file))
+    # process_bundle_file loads it next, before the blocks that follow this one.
+    blocks.pending_bundles.append(os.path.join(context_dir, local_file))
+    return True
 
 
 BLOCK_TYPE_COMMANDS: Mapping[str, Callable[[Blocks, Mapping[str, Any], str], bool]] = {
@@ -1754,7 +1864,37 @@ def parse_block_cmd(
 # Compression
 
 
-def compress_dictionary_creation(body: bytes) -> Tuple[int, Dict[bytes, int]]:
+# Number of times the dictionary pick is refined against the encoded body.
+COMPRESS_TRAINING_ROUNDS = 4
+
+# Smallest body, in bytes, worth counting substrings in worker processes.
+COMPRESS_PARALLEL_MIN_SIZE = 64 * 1024
+
+
+def compress_substring_counts(
+    body: bytes, length: int, limit: int
+) -> List[Tuple[bytes, int]]:
+    """Find the most common substrings of one length in the body.
+
+    Returns at most `limit` (substring, count) pairs, by count then by
+    first position.
+    """
+    get_slice = body.__getitem__
+    # Every substring of this length, in position order.  Counter counts an
+    # iterable in C, and map over slice objects builds the substrings without
+    # running Python code per position.
+    histo = Counter(
+        map(
+            get_slice,
+            map(slice, range(len(body) - length + 1), range(length, len(body) + 1)),
+        )
+    )
+    return histo.most_common(limit)
+
+
+def compress_dictionary_creation(
+    body: bytes,
+) -> Tuple[Dict[bytes, int], "array.array[int]"]:
     """Constructs a reverse lookup dictionary - the lookup string
     to the lookup index.
 
@@ -1763,96 +1903,205 @@ def compress_dictionary_creation(body: bytes) -> Tuple[int, Dict[bytes, int]]:
     (0-4095).  The very last dictionary entry is reserved as a end-of-stream
     marker.
 
-    Returns (max string length, dictionary)
-    """
-    # First, construct a histogram of the possiblities.
-    histo: Counter[bytes] = Counter()
-    body_len = len(body)
-    for count in range(2, 16):
-        for pos in range(0, body_len - count + 1):
-            histo[bytes(body[pos : pos + count])] += 1
+    The dictionary is picked by encoding the body with it, so the encoded
+    body comes back with it.
 
+    Returns (dictionary, encoded body)
+    """
     # Find all the distinct, single values in the stream.
     # These are required to be in the dictionary, but will
     # be
-    single_values: Counter[bytes] = Counter()
-    for val in body:
-        single_values[bytes([val])] += 1
+    # Count the byte values in C, then key them by the one byte string.
+    # Both keep first-seen order, which breaks frequency ties later.
+    single_values: Counter[bytes] = Counter(
+        {bytes((val,)): val_count for val, val_count in Counter(body).items()}
+    )
     # we'll use at most the top 12-bits minus the
     # individual byte count and the last value marker (1)
     # = 4096 - len(single_values) - 1 = 4095 - len(single_values) values
-    common = histo.most_common(4095 - len(single_values)) + single_values.most_common()
+    common_count = 4095 - len(single_values)
+    singles = list(single_values)
+
+    # First, construct a histogram of the possiblities.  Substrings of
+    # different lengths never collide, so each length is counted on its own,
+    # and only its most common entries are kept.  Large bodies count the
+    # lengths in parallel.
+    candidate_limit = common_count * 4
+    lengths = range(2, 16)
+    per_length: Optional[List[List[Tuple[bytes, int]]]] = None
+    worker_count = min(os.cpu_count() or 1, len(lengths))
+    if len(body) >= COMPRESS_PARALLEL_MIN_SIZE and worker_count > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=worker_count) as executor:
+                per_length = list(
+                    executor.map(
+                        compress_substring_counts,
+                        itertools.repeat(body),
+                        lengths,
+                        itertools.repeat(candidate_limit),
+                    )
+                )
+        except (OSError, NotImplementedError, BrokenProcessPool) as err:
+            debug("Counting substrings in one process: {err}", err=str(err))
+    if per_length is None:
+        per_length = [
+            compress_substring_counts(body, length, candidate_limit)
+            for length in lengths
+        ]
+    # The lists are joined in length order, and each one is in frequency then
+    # first-seen order, so ties still break the same as one shared histogram.
+    histo = dict(
+        heapq.nlargest(
+            candidate_limit,
+            itertools.chain.from_iterable(per_length),
+            key=operator.itemgetter(1),
+        )
+    )
+
+    # The most frequent substrings overlap each other, so the greedy encoder
+    # never uses many of them.  Train the pick against the actual encoding:
+    # drop the unused entries, refill from the next most frequent
+    # substrings, and keep whichever pick gives the smallest output.
+    candidates = list(histo)
+    chosen = candidates[:common_count]
+    next_candidate = len(chosen)
+    best = chosen
+    best_encoded = array.array("H")
+    best_size = -1
+    # One trie serves every round.  Between rounds only the changed strings
+    # are added or cleared, and the index payloads are renumbered.
+    root = compress_new_trie_node()
+    nodes = {sub: compress_trie_node(root, sub) for sub in chosen + singles}
+    for training_round in range(COMPRESS_TRAINING_ROUNDS + 1):
+        lookup = {sub: index for index, sub in enumerate(chosen + singles)}
+        for sub, index in lookup.items():
+            nodes[sub][256] = index
+        encoded = compress_encoded_body(body, root)
+        used = set(encoded)
+        # The body takes 12 bits per index, and the header stores each used entry.
+        size = (len(encoded) * 3 + 1) // 2 + sum(
+            len(sub) for sub in chosen if lookup[sub] in used
+        )
+        if 0 <= best_size <= size:
+            # The refill didn't shrink the output, and later rounds only
+            # refill from less frequent substrings.
+            break
+        best = chosen
+        best_encoded = encoded
+        best_size = size
+        if training_round == COMPRESS_TRAINING_ROUNDS:
+            break
+        kept = [sub for sub in chosen if lookup[sub] in used]
+        if len(chosen) - len(kept) <= len(chosen) // 16:
+            # Almost every entry is used, so there is little room to refill.
+            break
+        refill = candidates[next_candidate : next_candidate + common_count - len(kept)]
+        if not refill:
+            # Every entry is used, or no candidates are left.
+            break
+        next_candidate += len(refill)
+        for sub in chosen:
+            if lookup[sub] not in used:
+                nodes.pop(sub)[256] = -1
+        for sub in refill:
+            nodes[sub] = compress_trie_node(root, sub)
+        chosen = kept + refill
+
+    common = [(sub, histo[sub]) for sub in best] + single_values.most_common()
     common.sort(key=lambda a: a[1])
     assert len(common) <= 4095
 
     ret: Dict[bytes, int] = {}
-    index = 0
-    max_len = 0
-    for sub, _ in common:
-        max_len = max(max_len, len(sub))
+    for index, (sub, _) in enumerate(common):
         ret[sub] = index
-        index += 1
 
-    return max_len, ret
+    # Only the index numbers differ from the training encoding, so renumber
+    # that encoding rather than encode the body again.
+    new_index = [ret[sub] for sub in best + singles]
+    return ret, array.array("H", map(new_index.__getitem__, best_encoded))
+
 
+def compress_new_trie_node() -> List[Any]:
+    """Create an empty node for a byte trie over the lookup dictionary.
 
-def compress_encoded_body(
-    body: bytes, max_item_len: int, reverse_lookup: Dict[bytes, int]
-) -> List[int]:
-    """Encode the body into lookup table indexes."""
+    Each node is a list of 257 items; the first 256 are the child node for
+    that byte value (or None), and the last is the dictionary index of the
+    string ending at the node (or -1).
+    """
+    return [None] * 256 + [-1]
+
+
+def compress_trie_node(root: List[Any], sub: bytes) -> List[Any]:
+    """Find the trie node for the string, adding any missing nodes."""
+    node = root
+    for val in sub:
+        child = node[val]
+        if child is None:
+            child = compress_new_trie_node()
+            node[val] = child
+        node = child
+    return node
+
+
+def compress_encoded_body(body: bytes, root: List[Any]) -> "array.array[int]":
+    """Encode the body into lookup table indexes, using the dictionary trie.
+
+    The indexes are all 12-bit, so an unsigned short array holds them.
+    """
     pos = 0
     body_len = len(body)
-    ret: List[int] = []
+    ret = array.array("H")
     while pos < body_len:
-        # Find the longest string that is in the dictionary starting with pos.
-        try:
-            tail = min(pos + max_item_len + 1, body_len)
-            while tail > pos:
-                sub = body[pos:tail]
-                index = reverse_lookup.get(sub)
-                if index is not None:
-                    ret.append(index)
-                    pos = tail
-                    raise StopIteration
-                tail -= 1
-        except StopIteration:
-            pass
-        else:
+        # Find the longest string that is in the dictionary starting with pos,
+        # by walking the trie one byte at a time.
+        node = root
+        tail = pos
+        index = -1
+        end = pos
+        while tail < body_len:
+            node = node[body[tail]]
+            if node is None:
+                break
+            tail += 1
+            if node[256] >= 0:
+                index = node[256]
+                end = tail
+        if index < 0:
             raise RuntimeError(
-                f"Did not stop; incorrect substring table construction (@{pos}/{max_item_len}, c = {body[pos:pos+1]!r}, {reverse_lookup})"
+                f"Did not stop; incorrect substring table construction (@{pos}, c = {body[pos:pos+1]!r})"
             )
+        ret.append(index)
+        pos = end
     return ret
 
 
 def compress_compacted_body_lookup(
-    encoded: List[int], reverse_lookup: Dict[bytes, int]
-) -> Tuple[List[int], Dict[bytes, int]]:
+    encoded: "array.array[int]", reverse_lookup: Dict[bytes, int]
+) -> Tuple["array.array[int]", Dict[bytes, int]]:
     """A final pass over the body and lookup to compact it down to just the entries used."""
-    lookup: Dict[int, bytes] = {}
+    # The dictionary indexes run from 0 up, so a list works as the lookup.
+    lookup: List[bytes] = [b""] * len(reverse_lookup)
     for sub, orig_idx in reverse_lookup.items():
         lookup[orig_idx] = sub
+    lookup_lengths = list(map(len, lookup))
 
     # Because a fixed length encoding value is used, we don't care about ordering the
     # dictionary in terms of frequency.  However, due to the dictionary storage, it's smaller
     # to store it with same-sized entries grouped together.  So sort entries by size.
 
-    histo: Set[int] = set()
-    for idx in encoded:
-        histo.add(idx)
-    used_indicies = list(histo)
-    used_indicies.sort(key=lambda v: len(lookup[v]))
+    used_indicies = list(set(encoded))
+    used_indicies.sort(key=lookup_lengths.__getitem__)
+    if used_indicies == list(range(len(lookup))):
+        # Every entry is used and already in size order, so nothing changes.
+        return encoded, reverse_lookup
 
     old_to_new: Dict[int, int] = {}
     translated: Dict[bytes, int] = {}
-    count = 0
-    for orig_idx in used_indicies:
+    for count, orig_idx in enumerate(used_indicies):
         old_to_new[orig_idx] = count
         translated[lookup[orig_idx]] = count
-        count += 1
 
-    recoded: List[int] = []
-    for orig_idx in encoded:
-        recoded.append(old_to_new[orig_idx])
+    recoded = array.array("H", map(old_to_new.__getitem__, encoded))
 
     return recoded, translated
 
@@ -1863,76 +2112,61 @@ def mk_compress_header(reverse_lookup: Dict[bytes, int]) -> bytes:
     # index -> bytes.
     # Additionally, it writes (encoded byte count, number with the byte count)
     # The final sub-block is a 0 number of bytes with that count, and 0 count.
-    lookup: Dict[int, bytes] = {}
+    lookup: List[bytes] = [b""] * len(reverse_lookup)
     for key, index in reverse_lookup.items():
-        assert index not in lookup
+        assert not lookup[index]
         lookup[index] = key
+    assert lookup
 
-    # Create a list of shared size, in order of index.
-    # Seed the lists with index 0.
-    assert 0 in lookup
-    sized_ordered: List[List[bytes]] = [[lookup[0]]]
-    prev_len = len(lookup[0])
-    for idx in range(1, len(lookup)):
-        val = lookup[idx]
-        if len(val) != prev_len:
-            prev_len = len(val)
-            sized_ordered.append([])
-        elif len(sized_ordered[-1]) >= 15:
-            # Need to create another group, because each group is
-            # limited to 15 members.
-            sized_ordered.append([])
-        sized_ordered[-1].append(val)
-
-    header = b""
-    debug_idx = 0
-    for group in sized_ordered:
-        # Add the byte with the (item length - 1 | item count)
-        item_len = len(group[0])
+    # Write the groups of shared size, in order of index.
+    header = bytearray()
+    for item_len, same_len in itertools.groupby(lookup, len):
         assert 0 < item_len <= 16
-        item_count = len(group)
-        assert 0 < item_count < 16
-        group_header = ((item_len - 1) << 4) | item_count
-        header += mk_uint8(group_header)
-
-        for item in group:
-            # Directly add the whole item to the header.
-            # debug(f"d[{debug_idx}] = {item}")
-            # debug_idx += 1
-            header += item
+        items = list(same_len)
+        # Each group is limited to 15 members, so long runs span several groups.
+        for start in range(0, len(items), 15):
+            group = items[start : start + 15]
+            # Add the byte with the (item length - 1 | item count)
+            header.append(((item_len - 1) << 4) | len(group))
+            # Directly add the whole items to the header.
+            header += b"".join(group)
 
     # Put the terminator.
-    header += mk_uint8(0)
+    header.append(0)
     debug(f"Compression header size: {len(header)} bytes")
-    return header
+    return bytes(header)
 
 
-def mk_encoded_body(encoded: List[int], table_size: int) -> bytes:
+def mk_encoded_body(encoded: "array.array[int]", table_size: int) -> bytes:
     """Convert the body into index lookups in the lookup table."""
-    ret = b""
-    remainder = 0
-    is_odd = False
-    for idx in encoded:
-        # Do the variable length encoding
-        # debug(f"[] = {idx}")
-        if is_odd:
-            ret += bytes([remainder | ((idx >> 8) & 0xF)])
-            ret += bytes([idx & 0xFF])
-        else:
-            ret += bytes([(idx >> 4) & 0xFF])
-            remainder = (idx << 4) & 0xF0
-        is_odd = not is_odd
     # Add the table size index to mark the end of the data.
+    indexes = array.array("H", encoded)
+    indexes.append(table_size)
+    # Each pair of 12-bit indexes packs into 3 bytes.  With an odd count,
+    # the end marker is paired with a zero, and only the byte holding the
+    # marker's low nybble is kept from that last triple.
+    is_odd = len(indexes) % 2 == 1
     if is_odd:
-        ret += bytes([remainder | ((table_size >> 8) & 0xF)])
-        ret += bytes([table_size & 0xFF])
-    else:
-        ret += bytes([(table_size >> 4) & 0xFF])
-        # Directly add the value to the buffer, not to the remainder.
-        ret += bytes([(table_size << 4) & 0xF0])
+        indexes.append(0)
+    pair_count = len(indexes) // 2
+    # Pack each pair into the top 3 bytes of a big-endian uint32, then drop
+    # the low byte of each one.
+    ret = bytearray(
+        struct.pack(
+            f">{pair_count}I",
+            *map(
+                operator.or_,
+                map(operator.lshift, indexes[0::2], itertools.repeat(20)),
+                map(operator.lshift, indexes[1::2], itertools.repeat(8)),
+            ),
+        )
+    )
+    del ret[3::4]
+    if is_odd:
+        del ret[-1]
 
     debug(f"Compressed body size: {len(ret)} bytes")
-    return ret
+    return bytes(ret)
 
 
 def compress(body: bytes) -> bytes:
@@ -1951,28 +2185,32 @@ def compress(body: bytes) -> bytes:
     """
 
     # Create a reverse lookup without bytes, and the encoded body.
-    max_len, reverse_lookup = compress_dictionary_creation(body)
-    encoded = compress_encoded_body(body, max_len, reverse_lookup)
+    reverse_lookup, encoded = compress_dictionary_creation(body)
     encoded, reverse_lookup = compress_compacted_body_lookup(encoded, reverse_lookup)
 
     # Create the encoding block
-    ret = mk_block_header(FILE_VERSION__COMPRESSED)
-    ret += mk_compress_header(reverse_lookup)
-    ret += mk_encoded_body(encoded, len(reverse_lookup))
+    return b"".join(
+        (
+            mk_block_header(FILE_VERSION__COMPRESSED),
+            mk_compress_header(reverse_lookup),
+            mk_encoded_body(encoded, len(reverse_lookup)),
+        )
+    )
 
-    return ret
+
+def convert_lines(data: bytes, wide: bool) -> Iterator[str]:
+    """Convert the data into the encoded form, one line of text at a time."""
+    res = base64.a85encode(data).decode("ascii")
+    if wide:
+        yield res
+        return
+    for pos in range(0, len(res), 100):
+        yield res[pos : pos + 100] + "\n"
 
 
 def convert(data: bytes, wide: bool) -> str:
     """Convert the data into the encoded form."""
-    res = base64.a85encode(data).decode("ascii")
-    ret = ""
-    while res:
-        ret += res[:100]
-        if not wide:
-            ret += "\n"
-        res = res[100:]
-    return ret
+    return "".join(convert_lines(data, wide))
 
 
 # ==================================================================
@@ -1987,26 +2225,15 @@ def mk_initial_blocks() -> Blocks:
     return blocks
 
 
-def parse_json(blocks: Blocks, data: Any, context_dir: str) -> None:
-    """Parse the json data into the block store."""
-    if not isinstance(data, (list, tuple)):
-        log_error("Bundle data must be an array of blocks.")
-        return None
-
-    for block in data:
-        parse_block_cmd(blocks, block, context_dir)
-
-
-def process_bundle_file(blocks: Blocks, filename: str) -> bool:
-    """Read a bundle file and load it into the blocks.
-    Return False on error, True on okay
-    """
+def read_bundle_file(blocks: Blocks, filename: str) -> Optional[Sequence[Any]]:
+    """Read a bundle file's list of blocks.  Returns None if it could not be
+    read, or no blocks if it was already processed or isn't a list."""
     fqn = os.path.abspath(filename)
     if fqn in blocks.bundle_files:
         debug("Already processed {fqn}", fqn=fqn)
-        return True
+        return ()
 
-    blocks.bundle_files.append(fqn)
+    blocks.bundle_files.add(fqn)
     try:
         with open(filename, "r", encoding="utf-8") as fis:
             data = json.load(fis)
@@ -2016,9 +2243,42 @@ def process_bundle_file(blocks: Blocks, filename: str) -> bool:
             source=filename,
             err=str(err),
         )
+        return None
+
+    if not isinstance(data, (list, tuple)):
+        log_error("Bundle data must be an array of blocks.")
+        return ()
+    return data
+
+
+def process_bundle_file(blocks: Blocks, filename: str) -> bool:
+    """Read a bundle file and load it into the blocks.
+    Return False on error, True on okay
+
+    Nested bundles are loaded in place of their 'bundle' block.  They are
+    walked with an explicit stack rather than by recursion, so deep nesting
+    can't run into the interpreter's recursion limit.
+    """
+    data = read_bundle_file(blocks, filename)
+    if data is None:
         return False
 
-    parse_json(blocks, data, os.path.dirname(filename))
+    # Each entry is a bundle's remaining blocks, and the directory they are
+    # relative to.
+    stack: List[Tuple[Iterator[Any], str]] = [(iter(data), os.path.dirname(filename))]
+    while stack:
+        remaining, context_dir = stack[-1]
+        for block in remaining:
+            parse_block_cmd(blocks, block, context_dir)
+            if blocks.pending_bundles:
+                nested = blocks.pending_bundles.pop()
+                nested_data = read_bundle_file(blocks, nested)
+                if nested_data:
+                    # Finish the nested bundle before the rest of this one.
+                    stack.append((iter(nested_data), os.path.dirname(nested)))
+                    break
+        else:
+            stack.pop()
     return True
 
 
@@ -2098,7 +2358,7 @@ def main(args: Sequence[str]) -> int:
     )
     parsed = parser.parse_args(args[1:])
 
-    VERBOSE[0] = parsed.verbose
+    set_verbose(parsed.verbose)
     source = parsed.filename
     if not os.path.isfile(source):
         log_error("Provided source file is not a file: {source}", source=source)
@@ -2134,25 +2394,26 @@ def main(args: Sequence[str]) -> int:
             )
     elif outfile is not None:
         sys.stderr.write(f"{outfile}: {pre_size} bytes\n")
-    out = convert(block_data, not parsed.multiline)
     if outfile is None:
-        print(out)
+        sys.stdout.writelines(convert_lines(block_data, not parsed.multiline))
+        sys.stdout.write("\n")
+    elif parsed.split_file:
+        out = convert(block_data, not parsed.multiline)
+        for file_idx, pos in enumerate(range(0, len(out), MAXIMUM_GREYHACK_FILE_SIZE)):
+            with open(f"{outfile}.{file_idx}", "w", encoding="utf-8") as fos:
+                fos.write(out[pos : pos + MAXIMUM_GREYHACK_FILE_SIZE])
     else:
-        if parsed.split_file:
-            file_idx = 0
-            while out:
-                with open(f"{outfile}.{file_idx}", "w", encoding="utf-8") as fos:
-                    fos.write(out[:MAXIMUM_GREYHACK_FILE_SIZE])
-                file_idx += 1
-                out = out[MAXIMUM_GREYHACK_FILE_SIZE:]
-        else:
-            with open(outfile, "w", encoding="utf-8") as fos:
-                fos.write(out)
-            if len(out) > MAXIMUM_GREYHACK_FILE_SIZE:
-                sys.stderr.write(
-                    f"Warning: output size ({len(out)}) exceeded maximum game text file size ({MAXIMUM_GREYHACK_FILE_SIZE}).\n"
-                    f"Try using the '--split' argument to turn the file into a size usable by the game.\n"
-                )
+        # Write the lines as they are made, rather than joining them first.
+        out_size = 0
+        with open(outfile, "w", encoding="utf-8") as fos:
+            for line in convert_lines(block_data, not parsed.multiline):
+                fos.write(line)
+                out_size += len(line)
+        if out_size > MAXIMUM_GREYHACK_FILE_SIZE:
+            sys.stderr.write(
+                f"Warning: output size ({out_size}) exceeded maximum game text file size ({MAXIMUM_GREYHACK_FILE_SIZE}).\n"
+                f"Try using the '--split' argument to turn the file into a size usable by the game.\n"
+            )
     return 0
 
 
@@ -0,0 +1,60 @@
+"""Tests for the ghtar compression."""
+
+import os
+import random
+import sys
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ghtar  # noqa: E402
+
+
+class BrokenExecutor:
+    """A process pool whose workers have all died."""
+
+    def __init__(self, *_args: Any, **_kwargs: Any) -> None:
+        pass
+
+    def __enter__(self) -> "BrokenExecutor":
+        return self
+
+    def __exit__(self, *_args: Any) -> None:
+        pass
+
+    def map(self, *_args: Any) -> Any:
+        raise BrokenProcessPool("A process in the process pool was terminated")
+
+
+def mk_body(size: int) -> bytes:
+    """Make a repeatable, text like body."""
+    rand = random.Random(1)
+    words = [
+        "".join(rand.choice("abcdefghij") for _ in range(rand.randint(2, 8)))
+        for _ in range(300)
+    ]
+    ret = bytearray()
+    while len(ret) < size:
+        ret += rand.choice(words).encode("ascii") + b" "
+    return bytes(ret[:size])
+
+
+class CompressDictionaryCreationTest(unittest.TestCase):
+    """Tests for compress_dictionary_creation."""
+
+    def test_broken_process_pool_falls_back(self) -> None:
+        body = mk_body(ghtar.COMPRESS_PARALLEL_MIN_SIZE + 100)
+        with mock.patch.object(ghtar.os, "cpu_count", return_value=1):
+            expected = ghtar.compress_dictionary_creation(body)
+        with mock.patch.object(
+            ghtar.os, "cpu_count", return_value=4
+        ), mock.patch.object(ghtar, "ProcessPoolExecutor", BrokenExecutor):
+            actual = ghtar.compress_dictionary_creation(body)
+        self.assertEqual(expected, actual)
+
+
+if __name__ == "__main__":
+    unittest.main()